@@ -1,49 +1,47 @@
 #!/usr/bin/env python3
 
 import pandas as pd
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import json
 import os, sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import bisect
+import gzip
+import hashlib
+import urllib.request
+
+try:
+    import brotli  # opcional: variantes .br del modo bundle
+except ImportError:
+    brotli = None
 
 CSV = "datos_consolidados_20251104_141743.csv"
 OUT = "mapa_compacto_v4.html"
+# regiones para los agregados: GeoJSON opcional (municipios/zonas) junto al script; si no existe se usan celdas de GRID_DEG grados
+REGIONES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "regiones.geojson")
+GRID_DEG = 0.25
+# recursos de terceros del template: (archivo, URL con versión exacta, sha256 esperado). El modo bundle los descarga
+# una vez a VENDOR_DIR y verifica el sha256 al descargar y al reutilizar la caché antes de incrustarlos o copiarlos.
+# sha256 None = aún no fijado: el bundle se niega a usarlo y muestra el hash obtenido para revisarlo y anotarlo aquí.
+VENDOR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vendor")
+VENDOR_ASSETS = [
+    ('leaflet.css', 'https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.css',
+     '90b693d86392a4779c861b28cf307e7e59c3fb35328c4d8b95f58f814d38c722'),
+    ('MarkerCluster.css', 'https://cdnjs.cloudflare.com/ajax/libs/leaflet.markercluster/1.1.0/MarkerCluster.css', None),
+    ('MarkerCluster.Default.css', 'https://cdnjs.cloudflare.com/ajax/libs/leaflet.markercluster/1.1.0/MarkerCluster.Default.css', None),
+    ('leaflet.js', 'https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.js',
+     '5819285cec137b229c94e1ee5ad73e8b6b84345a4367d60f75fe477fe0fb7b03'),
+    ('leaflet.markercluster.js', 'https://cdnjs.cloudflare.com/ajax/libs/leaflet.markercluster/1.1.0/leaflet.markercluster.js', None),
+    ('chart.umd.min.js', 'https://cdn.jsdelivr.net/npm/chart.js@4.4.0/dist/chart.umd.min.js', None),
+    ('chartjs-adapter-date-fns.bundle.min.js',
+     'https://cdn.jsdelivr.net/npm/chartjs-adapter-date-fns@3.0.0/dist/chartjs-adapter-date-fns.bundle.min.js', None)
+]
 
-if not os.path.exists(CSV):
-    print(f"ERROR: no se encuentra el CSV '{CSV}' en el directorio actual.", file=sys.stderr)
-    sys.exit(1)
-
-print(" Leyendo CSV (puede tardar unos segundos)...")
-df = pd.read_csv(CSV, low_memory=False)
-
-# columnas mínimas
-for c in ['timestamp', 'latitud', 'longitud']:
-    if c not in df.columns:
-        print(f"ERROR: El CSV debe contener la columna '{c}'.", file=sys.stderr)
-        sys.exit(1)
-
-# normalizar y limpiar
-df['timestamp'] = pd.to_datetime(df['timestamp'], errors='coerce')
-df['latitud'] = pd.to_numeric(df['latitud'], errors='coerce')
-df['longitud'] = pd.to_numeric(df['longitud'], errors='coerce')
-df = df.dropna(subset=['timestamp','latitud','longitud']).copy()
-df = df.sort_values('timestamp')
-
-# generar estacion_id si no existe
-if 'estacion_id' not in df.columns:
-    if 'nombre_estacion' in df.columns:
-        df['estacion_id'] = df['nombre_estacion'].astype(str).fillna('').replace('', None)
-        df.loc[df['estacion_id'].isna(), 'estacion_id'] = df.loc[df['estacion_id'].isna()].apply(
-            lambda r: f"lat{r['latitud']}_lon{r['longitud']}", axis=1
-        )
-    else:
-        df['estacion_id'] = df.apply(lambda r: f"lat{r['latitud']}_lon{r['longitud']}", axis=1)
-
-# construir mapa lower->orig
-cols_lower = {c.lower(): c for c in df.columns}
-
-# función búsqueda por tokens preferenciales
-def find_col_by_tokens(tokens):
+# función búsqueda por tokens preferenciales (cols_lower: mapa lower->orig de las columnas del CSV)
+def find_col_by_tokens(tokens, cols_lower):
     for t in tokens:
         if t in cols_lower:
             return cols_lower[t]
@@ -63,14 +61,6 @@ mapping_tokens = {
     'pressure': ['presion_hpa','pressure_hpa','pressure','barometer','barometric_pressure','presion']
 }
 
-col_map = {}
-for var, tokens in mapping_tokens.items():
-    col_map[var] = find_col_by_tokens(tokens)
-
-print("ℹ️ Columnas mapeadas (None significa no encontrada):")
-for k,v in col_map.items():
-    print(f"  {k}: {v}")
-
 # función simple para calcular AQI aproximado desde PM2.5 (US EPA breakpoints)
 def pm25_to_aqi(pm):
     if pm is None:
@@ -94,112 +84,146 @@ def pm25_to_aqi(pm):
             return round(aqi, 0)
     return None
 
-# última lectura por estación
-last_by_station = df.groupby('estacion_id', as_index=False).last()
-latest_records = []
-for _, r in last_by_station.iterrows():
-    rec = {
-        'estacion_id': str(r.get('estacion_id')),
-        'nombre_estacion': r.get('nombre_estacion') if 'nombre_estacion' in r else None,
-        'latitud': float(r['latitud']),
-        'longitud': float(r['longitud']),
-        'timestamp': r['timestamp'].isoformat() if not pd.isna(r['timestamp']) else None
+# versión vectorizada (arrays numpy) con los mismos cortes; trunca a 0.1 µg/m³ como indica la EPA
+AQI_BREAKPOINTS = np.array([
+    (0.0, 12.0, 0, 50),
+    (12.1, 35.4, 51, 100),
+    (35.5, 55.4, 101, 150),
+    (55.5, 150.4, 151, 200),
+    (150.5, 250.4, 201, 300),
+    (250.5, 350.4, 301, 400),
+    (350.5, 500.4, 401, 500)
+])
+
+def pm25_to_aqi_array(pm):
+    pm = np.floor(np.asarray(pm, dtype=float) * 10 + 1e-9) / 10
+    clow, chigh, ilow, ihigh = AQI_BREAKPOINTS.T
+    band = np.clip(np.searchsorted(chigh, pm, side='left'), 0, len(chigh) - 1)
+    aqi = (ihigh[band] - ilow[band]) / (chigh[band] - clow[band]) * (pm - clow[band]) + ilow[band]
+    return np.where((pm >= 0) & (pm <= chigh[-1]), np.round(aqi), np.nan)
+
+# NowCast EPA de PM2.5 sobre una matriz horaria regular (tiempo × estación), todas las estaciones a la vez.
+# c1 = hora actual; w = max(cmin/cmax, 0.5) en la ventana de 12 h; requiere 2 de las 3 horas más recientes.
+NOWCAST_HOURS = 12
+ROLLING_HOURS = 24
+ROLLING_MIN_HOURS = 18  # 75 % de completitud para la media de 24 h
+
+def nowcast_pm25(M):
+    M = np.asarray(M, dtype=float)
+    pad = np.vstack([np.full((NOWCAST_HOURS - 1, M.shape[1]), np.nan), M])
+    win = sliding_window_view(pad, NOWCAST_HOURS, axis=0)[..., ::-1]
+    valid = ~np.isnan(win)
+    cmax = np.fmax.reduce(win, axis=2)
+    cmin = np.fmin.reduce(win, axis=2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = np.clip(np.where(cmax > 0, cmin / cmax, 1.0), 0.5, 1.0)
+        pw = np.where(valid, w[..., None] ** np.arange(NOWCAST_HOURS), 0.0)
+        nc = (np.where(valid, win, 0.0) * pw).sum(axis=2) / pw.sum(axis=2)
+    nc[valid[..., :3].sum(axis=2) < 2] = np.nan
+    return nc
+
+def rolling_mean_24h(M):
+    return pd.DataFrame(M).rolling(ROLLING_HOURS, min_periods=ROLLING_MIN_HOURS).mean().to_numpy()
+
+def rolling_aqi(pm_wide):
+    """NowCast, AQI NowCast y media 24 h para un DataFrame horario regular (índice = horas, columnas = estaciones)."""
+    M = pm_wide.to_numpy(dtype=float)
+    nc = nowcast_pm25(M)
+    out = {
+        'pm25_nowcast': nc,
+        'aqi_nowcast': pm25_to_aqi_array(nc),
+        'pm25_24h': rolling_mean_24h(M)
     }
-    for key in mapping_tokens.keys():
-        col = col_map.get(key)
-        if col:
-            val = r.get(col)
-            try:
-                rec[key] = None if pd.isna(val) else float(val)
-            except Exception:
-                rec[key] = None
-        else:
-            rec[key] = None
-    if (rec.get('aqi') is None) and rec.get('pm25') not in (None,):
-        rec['aqi'] = pm25_to_aqi(rec.get('pm25'))
-    latest_records.append(rec)
-
-# construir historiales: resample 1H para las variables canónicas
+    return {k: pd.DataFrame(v, index=pm_wide.index, columns=pm_wide.columns) for k, v in out.items()}
+
+def rolling_aqi_append(tail, row, t):
+    """Actualización incremental: agrega la hora t (Series por estación) a la cola de 24 h y calcula solo esa fila.
+    t puede repetir la última hora de la cola (lecturas de esa hora que llegan después: se combinan con las que ya
+    estaban); una hora anterior cambiaría las filas siguientes y se rechaza con ValueError (usar rolling_aqi).
+    Devuelve (nueva cola, {variable: Series por estación})."""
+    t = pd.Timestamp(t)
+    if len(tail) and t < tail.index[-1]:
+        raise ValueError(f"la hora {t} es anterior a la última de la cola ({tail.index[-1]}); recalcule con rolling_aqi")
+    if len(tail):
+        gap = pd.date_range(tail.index[-1], t, freq='h')[1:]
+        tail = tail.reindex(tail.index.append(gap))
+    tail = tail.reindex(columns=tail.columns.union(row.index))
+    if t not in tail.index:
+        tail.loc[t] = np.nan
+    tail.loc[t, row.index] = row.to_numpy(dtype=float)
+    tail = tail.iloc[-ROLLING_HOURS:]
+    M = tail.to_numpy(dtype=float)
+    nc = nowcast_pm25(M[-NOWCAST_HOURS:])[-1]
+    last = M[-ROLLING_HOURS:]
+    n_ok = (~np.isnan(last)).sum(axis=0)
+    with np.errstate(invalid='ignore'):
+        m24 = np.where(n_ok >= ROLLING_MIN_HOURS, np.nansum(last, axis=0) / np.maximum(n_ok, 1), np.nan)
+    vals = {'pm25_nowcast': nc, 'aqi_nowcast': pm25_to_aqi_array(nc), 'pm25_24h': m24}
+    return tail, {k: pd.Series(v, index=tail.columns) for k, v in vals.items()}
+
+# Largest-Triangle-Three-Buckets: reduce una serie a n_out puntos conservando su forma visual.
+# Devuelve los índices de los puntos elegidos (x e y como arrays numpy sin NaN).
+def lttb_indices(x, y, n_out):
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    # n_out-2 buckets entre el primer y el último punto (que siempre se conservan)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    # promedios de todos los buckets de una vez (el último "bucket" es solo el punto final)
+    sizes = np.diff(np.append(edges, n))
+    mean_x = np.add.reduceat(x, edges) / sizes
+    mean_y = np.add.reduceat(y, edges) / sizes
+    idx = np.empty(n_out, dtype=int)
+    idx[0] = 0
+    idx[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        cx, cy = mean_x[i + 1], mean_y[i + 1]
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        idx[i + 1] = a
+    return idx
+
+# niveles precalculados para el gráfico del panel (puntos objetivo ~ ancho en píxeles CSS del canvas: ~270 px en
+# escritorio junto a Detalles; en móvil, más ancho, se usa el mayor)
+lttb_targets = [150, 300]
+lttb_vars = ['pm25', 'temp']
+
+def lttb_levels(res, col_by_var):
+    """Series del gráfico del panel para toda la historia horaria de una estación.
+    Devuelve (niveles, completa): niveles = {target: {var: {'h': [...], 'v': [...]}}}, con 'h' = horas desde la
+    primera hora de la serie, solo donde target <= len/2; cada nivel se deriva del siguiente más grande (300 → 150).
+    completa = series demasiado cortas para cualquier nivel, enteras."""
+    hours = ((res.index - res.index[0]) // pd.Timedelta(hours=1)).to_numpy()
+    x_all = hours.astype(float)
+    levels, full = {}, {}
+    for v, col in col_by_var.items():
+        y_all = res[col].to_numpy(dtype=float)
+        pos = np.flatnonzero(~np.isnan(y_all))
+        if not len(pos):
+            continue
+        n = len(pos)
+        for target in sorted(lttb_targets, reverse=True):
+            if 2 * target > n:
+                continue
+            pos = pos[lttb_indices(x_all[pos], y_all[pos], target)]
+            levels.setdefault(str(target), {})[v] = {
+                'h': hours[pos].tolist(),
+                'v': [round(float(val), 2) for val in y_all[pos]]
+            }
+        if len(pos) == n:
+            full[v] = {'h': hours[pos].tolist(), 'v': [round(float(val), 2) for val in y_all[pos]]}
+    return levels, full
+
+# historiales: resample 1H para las variables canónicas, recortados a max_points horas
 max_points = 168
-station_histories = {}
-all_times_set = set()
 vars_canonical = ['timestamps','pm25','pm10','pm1','temp','humidity','precip','aqi','wind_speed','wind_dir','pressure']
-
-for station_id, g in df.groupby('estacion_id'):
-    g = g.set_index('timestamp').sort_index()
-    rec = {k: [] for k in vars_canonical}
-    needed_cols = [col_map[v] for v in col_map if col_map[v] is not None]
-    if not needed_cols:
-        station_histories[str(station_id)] = rec
-        continue
-    res = g[needed_cols].resample('1H').mean()
-    res = res.dropna(how='all')
-    if res.empty:
-        station_histories[str(station_id)] = rec
-        continue
-    timestamps = [ts.isoformat() for ts in res.index]
-    all_times_set.update(timestamps)
-    for v in vars_canonical:
-        if v == 'timestamps':
-            continue
-        col = col_map.get(v)
-        if col:
-            vals = []
-            for val in res[col].tolist():
-                vals.append(None if pd.isna(val) else float(val))
-            rec[v] = vals
-        else:
-            if v == 'aqi':
-                pmvals = []
-                pmcol = col_map.get('pm25')
-                if pmcol and pmcol in res:
-                    for val in res[pmcol].tolist():
-                        pmvals.append(None if pd.isna(val) else pm25_to_aqi(val))
-                rec[v] = pmvals if pmvals else [None]*len(timestamps)
-            else:
-                rec[v] = [None]*len(timestamps)
-    if len(timestamps) > max_points:
-        timestamps = timestamps[-max_points:]
-        for k in rec:
-            if k == 'timestamps': continue
-            if rec[k]:
-                rec[k] = rec[k][-max_points:]
-    rec['timestamps'] = timestamps
-    station_histories[str(station_id)] = rec
-
-# ordenar all times
-all_times = sorted(all_times_set, key=lambda x: datetime.fromisoformat(x)) if all_times_set else []
-
-# estadísticas por estación (mean de columnas numéricas, n, rango temporal)
-numeric_cols = df.select_dtypes(include=['number']).columns.tolist()
-numeric_cols = [c for c in numeric_cols if c not in ('latitud','longitud')]
-station_stats = {}
-for station_id, g in df.groupby('estacion_id'):
-    stats = {}
-    gg = g.copy()
-    stats['n_muestras'] = int(len(gg))
-    stats['primera_lectura'] = gg['timestamp'].min().isoformat() if not gg['timestamp'].isna().all() else None
-    stats['ultima_lectura'] = gg['timestamp'].max().isoformat() if not gg['timestamp'].isna().all() else None
-    for col in numeric_cols:
-        try:
-            m = gg[col].dropna().mean()
-            stats[col] = None if pd.isna(m) else round(float(m), 2)
-        except Exception:
-            stats[col] = None
-    # asegurar que stats tenga canónicas (si no están calculadas, intentar promediar desde mapeos)
-    for v in ['pm25','temp','humidity','precip','aqi','pm1','pm10','wind_speed','pressure']:
-        if v not in stats or stats.get(v) is None:
-            col = col_map.get(v)
-            if col and col in gg:
-                try:
-                    mv = gg[col].dropna().mean()
-                    stats[v] = None if pd.isna(mv) else round(float(mv), 2)
-                except:
-                    stats[v] = None
-    # si no hay aqi en stats pero hay pm25 promedio, calcular
-    if (stats.get('aqi') in (None,)) and stats.get('pm25') not in (None,):
-        stats['aqi'] = pm25_to_aqi(stats.get('pm25'))
-    station_stats[str(station_id)] = stats
+rolling_vars = ['pm25_nowcast', 'aqi_nowcast', 'pm25_24h']
+# variables de los promedios globales y de los agregados por región
+global_vars = ['pm25','temp','humidity','precip']
+# prioridad de campos para Detalles
+priority_order = ['pm25','temp','humidity','precip','aqi','wind_speed','wind_dir','pressure','pm1','pm10']
 
 # etiquetas legibles (mapeo manual para detalles: nombres más entendibles)
 label_map = {
@@ -212,41 +236,12 @@ label_map = {
     'aqi': 'ICA / AQI',
     'wind_speed': 'Velocidad del viento (km/h)',
     'wind_dir': 'Dirección del viento',
-    'pressure': 'Presión (hPa)'
+    'pressure': 'Presión (hPa)',
+    'pm25_nowcast': 'PM2.5 NowCast (µg/m³)',
+    'aqi_nowcast': 'ICA NowCast',
+    'pm25_24h': 'PM2.5 media 24 h (µg/m³)'
 }
 
-# Selección de hasta 10 campos relevantes para Detalles: priorizo indispensables y opcionales
-priority_order = ['pm25','temp','humidity','precip','aqi','wind_speed','wind_dir','pressure','pm1','pm10']
-selected_keys = []
-for key in priority_order:
-    any_non_null = any((station_stats[sid].get(key) not in (None,) for sid in station_stats))
-    if any_non_null:
-        selected_keys.append(key)
-# si quedaron menos de 10, añadir otras numeric cols (convertir a legible)
-for col in numeric_cols:
-    if len(selected_keys) >= 10: break
-    if col.lower() in selected_keys:
-        continue
-    # tratar nombres no canónicos
-    if col not in selected_keys:
-        selected_keys.append(col)
-selected_keys = selected_keys[:10]
-
-print("ℹ️ Campos finales para Detalles (limitados, legibles):")
-for k in selected_keys:
-    lab = label_map.get(k, k.replace('_',' '))
-    print("   -", k, "→", lab)
-
-# centro del mapa
-center_lat = float(df['latitud'].mean())
-center_lon = float(df['longitud'].mean())
-
-# --- CALCULAR PROMEDIOS GLOBALES POR TIEMPO (para visualizaciones globales) ---
-global_vars = ['pm25','temp','humidity','precip']
-station_time_index = {}
-for sid, rec in station_histories.items():
-    station_time_index[sid] = rec.get('timestamps', [])
-
 def last_value_before(rec, times_list, t_iso, var):
     if not times_list:
         return None
@@ -258,22 +253,37 @@ def last_value_before(rec, times_list, t_iso, var):
         return None
     return vals[i]
 
-global_averages = []
-for t in all_times:
-    row = {'timestamp': t}
-    for v in global_vars:
-        vals = []
-        for sid, rec in station_histories.items():
-            ts_list = station_time_index.get(sid, [])
-            val = last_value_before(rec, ts_list, t, v)
-            if val is not None:
-                try:
-                    f = float(val)
-                    if not pd.isna(f): vals.append(f)
-                except:
-                    pass
-        row[v] = round(sum(vals)/len(vals), 2) if vals else None
-    global_averages.append(row)
+# --- AGREGADOS POR REGIÓN Y POR TIPO DE EQUIPO (vista intermedia entre global y estación) ---
+# point-in-polygon vectorizado (regla par-impar sobre todos los anillos, así los huecos quedan fuera)
+def points_in_rings(lat, lon, rings):
+    crossings = np.zeros(len(lat), dtype=int)
+    py, px = lat[:, None], lon[:, None]
+    for ring in rings:
+        r = np.asarray(ring, dtype=float)
+        x1, y1 = r[:, 0], r[:, 1]
+        x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xint = (x2 - x1) * (py - y1) / (y2 - y1) + x1
+        crossings += (((y1 > py) != (y2 > py)) & (px < xint)).sum(axis=1)
+    return crossings % 2 == 1
+
+def load_region_polygons(path):
+    """Lista [(nombre, anillos)] desde un GeoJSON de Polygon/MultiPolygon."""
+    with open(path, encoding='utf-8') as f:
+        gj = json.load(f)
+    regions = []
+    for i, feat in enumerate(gj.get('features', [])):
+        props = {k.lower(): v for k, v in (feat.get('properties') or {}).items()}
+        name = next((props[k] for k in ('nombre','name','mpio_cnmbr','municipio','zona') if props.get(k)), f"Región {i+1}")
+        geom = feat.get('geometry') or {}
+        if geom.get('type') == 'Polygon':
+            rings = geom['coordinates']
+        elif geom.get('type') == 'MultiPolygon':
+            rings = [ring for poly in geom['coordinates'] for ring in poly]
+        else:
+            continue
+        regions.append((str(name), rings))
+    return regions
 
 # leyenda semántica (PM2.5) actualizada para reemplazo en template
 legend = [
@@ -284,6 +294,512 @@ legend = [
     {'max':9999, 'label':'Peligroso', 'color':'#e74c3c'}
 ]
 
+# --- ÍNDICE DE EPISODIOS (saltar al siguiente evento en la línea de tiempo) ---
+# umbral: PM2.5 sube a una banda peor de la leyenda respecto a la hora anterior (desde UMBRAL_MIN_BANDA), la banda
+#         nueva se sostiene UMBRAL_MIN_HORAS y supera la banda sostenida de las UMBRAL_ENFRIAMIENTO_H horas previas
+#         (así un valor que oscila alrededor de un límite no dispara un evento por cada cruce)
+# pico: PM2.5 >= SPIKE_RATIO × mediana de las 24 h previas y al menos SPIKE_MIN_UGM3 por encima (solo el inicio)
+# lluvia: precipitación horaria >= PRECIP_FUERTE_MM (solo el inicio de cada racha)
+UMBRAL_MIN_BANDA = 2  # 'Regular'
+UMBRAL_MIN_HORAS = 3
+UMBRAL_ENFRIAMIENTO_H = 6
+SPIKE_RATIO = 2.0
+SPIKE_MIN_UGM3 = 10.0
+PRECIP_FUERTE_MM = 7.6
+event_kinds = ['umbral', 'pico', 'lluvia']
+
+def onsets(mask):
+    prev = np.vstack([np.zeros((1, mask.shape[1]), dtype=bool), mask[:-1]])
+    return mask & ~prev
+
+def detect_episodes(pm_wide, precip_wide):
+    """Eventos en columnas: hora, estación, tipo, valor y detalle (banda o línea base), a partir de las matrices horarias."""
+    found = []
+    if pm_wide is not None:
+        P = pm_wide.to_numpy(dtype=float)
+        ok = ~np.isnan(P)
+        band = np.searchsorted(np.array([b['max'] for b in legend], dtype=float), np.where(ok, P, 0), side='left')
+        band = np.minimum(band, len(legend) - 1)
+        prev_band = np.vstack([band[:1], band[:-1]])
+        prev_ok = np.vstack([np.zeros((1, P.shape[1]), dtype=bool), ok[:-1]])
+        # banda sostenida: la menor de las próximas UMBRAL_MIN_HORAS horas (-1 si falta alguna o aún no se completan)
+        held = pd.DataFrame(np.where(ok, band, -1)).rolling(UMBRAL_MIN_HORAS).min().shift(-(UMBRAL_MIN_HORAS - 1))
+        prev_held = held.rolling(UMBRAL_ENFRIAMIENTO_H, min_periods=1).max().shift(1)
+        held = held.fillna(-1).to_numpy(dtype=int)
+        prev_held = prev_held.fillna(-1).to_numpy(dtype=int)
+        up = prev_ok & (held > prev_band) & (held > prev_held) & (held >= UMBRAL_MIN_BANDA)
+        labels = np.array([b['label'] for b in legend], dtype=object)
+        found.append((pm_wide, up, 'umbral', P, labels[np.maximum(held, 0)]))
+        base = pm_wide.rolling(24, min_periods=6).median().shift(1).to_numpy(dtype=float)
+        with np.errstate(invalid='ignore'):
+            spike = ok & (P >= SPIKE_RATIO * base) & (P - base >= SPIKE_MIN_UGM3)
+        found.append((pm_wide, onsets(spike), 'pico', P, np.round(base, 2).astype(object)))
+    if precip_wide is not None:
+        R = precip_wide.to_numpy(dtype=float)
+        with np.errstate(invalid='ignore'):
+            heavy = R >= PRECIP_FUERTE_MM
+        found.append((precip_wide, onsets(heavy), 'lluvia', R, np.full(R.shape, None, dtype=object)))
+    ts, sids, kinds, vals, details = [], [], [], [], []
+    for wide, mask, kind, values, detail in found:
+        ti, si = np.nonzero(mask)
+        ts.extend(wide.index[ti])
+        sids.extend(wide.columns[si])
+        kinds.extend([event_kinds.index(kind)] * len(ti))
+        vals.extend(np.round(values[ti, si], 2))
+        details.extend(detail[ti, si])
+    return {'t': ts, 's': np.array(sids, dtype=object), 'k': np.array(kinds, dtype=int),
+            'v': np.array(vals, dtype=float), 'd': np.array(details, dtype=object)}
+
+# ---------------- ETAPAS ----------------
+# load_dataset y prepare_context se ejecutan una sola vez; build_payload una vez por cada salida (página).
+
+def load_dataset(csv_path):
+    """Lee y normaliza el CSV; devuelve (df, col_map)."""
+    if not os.path.exists(csv_path):
+        print(f"ERROR: no se encuentra el CSV '{csv_path}' en el directorio actual.", file=sys.stderr)
+        sys.exit(1)
+
+    print(" Leyendo CSV (puede tardar unos segundos)...")
+    df = pd.read_csv(csv_path, low_memory=False)
+
+    # columnas mínimas
+    for c in ['timestamp', 'latitud', 'longitud']:
+        if c not in df.columns:
+            print(f"ERROR: El CSV debe contener la columna '{c}'.", file=sys.stderr)
+            sys.exit(1)
+
+    # normalizar y limpiar
+    df['timestamp'] = pd.to_datetime(df['timestamp'], errors='coerce')
+    df['latitud'] = pd.to_numeric(df['latitud'], errors='coerce')
+    df['longitud'] = pd.to_numeric(df['longitud'], errors='coerce')
+    df = df.dropna(subset=['timestamp','latitud','longitud']).copy()
+    df = df.sort_values('timestamp')
+
+    # generar estacion_id si no existe
+    if 'estacion_id' not in df.columns:
+        if 'nombre_estacion' in df.columns:
+            df['estacion_id'] = df['nombre_estacion'].astype(str).fillna('').replace('', None)
+            df.loc[df['estacion_id'].isna(), 'estacion_id'] = df.loc[df['estacion_id'].isna()].apply(
+                lambda r: f"lat{r['latitud']}_lon{r['longitud']}", axis=1
+            )
+        else:
+            df['estacion_id'] = df.apply(lambda r: f"lat{r['latitud']}_lon{r['longitud']}", axis=1)
+
+    # construir mapa lower->orig
+    cols_lower = {c.lower(): c for c in df.columns}
+    col_map = {}
+    for var, tokens in mapping_tokens.items():
+        col_map[var] = find_col_by_tokens(tokens, cols_lower)
+
+    print("ℹ️ Columnas mapeadas (None significa no encontrada):")
+    for k,v in col_map.items():
+        print(f"  {k}: {v}")
+    return df, col_map
+
+def prepare_context(df, col_map, regiones_path=REGIONES):
+    """Trabajo compartido por todas las salidas: remuestreo horario por estación, NowCast/medias 24 h,
+    episodios sobre las matrices completas y asignación de zona / tipo de equipo."""
+    hourly = {}
+    needed_cols = [col_map[v] for v in col_map if col_map[v] is not None]
+    if needed_cols:
+        for station_id, g in df.groupby('estacion_id'):
+            g = g.set_index('timestamp').sort_index()
+            res = g[needed_cols].resample('1H').mean()
+            res = res.dropna(how='all')
+            if not res.empty:
+                hourly[str(station_id)] = res
+
+    # matriz horaria regular (hora × estación) de una variable; None si ninguna estación la tiene
+    def hourly_matrix(var):
+        col = col_map.get(var)
+        if not col or not hourly:
+            return None
+        wide = pd.DataFrame({sid: res[col] for sid, res in hourly.items()})
+        return wide.reindex(pd.date_range(wide.index.min(), wide.index.max(), freq='h'))
+
+    # NowCast / media 24 h: ventanas móviles sobre la matriz de PM2.5 en una pasada
+    pm_wide = hourly_matrix('pm25')
+    rolling = rolling_aqi(pm_wide) if pm_wide is not None else {}
+    # lluvia: el CSV trae mm por lectura, así que el total horario es la suma (la media de hourly lo subestima)
+    precip_wide = None
+    if col_map.get('precip') and hourly:
+        precip_wide = (df.set_index('timestamp').groupby('estacion_id')[col_map['precip']]
+                       .resample('h').sum(min_count=1).unstack('estacion_id'))
+        precip_wide.columns = precip_wide.columns.astype(str)
+        precip_wide = precip_wide.reindex(pd.date_range(precip_wide.index.min(), precip_wide.index.max(), freq='h'))
+    episodes = detect_episodes(pm_wide, precip_wide)
+
+    last_by_station = df.groupby('estacion_id', as_index=False).last()
+    station_coords = last_by_station[['estacion_id','latitud','longitud']].copy()
+    station_coords['estacion_id'] = station_coords['estacion_id'].astype(str)
+    st_lat = station_coords['latitud'].to_numpy(dtype=float)
+    st_lon = station_coords['longitud'].to_numpy(dtype=float)
+
+    # zona: primer polígono que contiene la estación; las que quedan fuera caen en su celda de la grilla
+    zone = np.full(len(station_coords), None, dtype=object)
+    if regiones_path and os.path.exists(regiones_path):
+        polygons = load_region_polygons(regiones_path)
+        print(f"ℹ️ Zonas: {len(polygons)} regiones de '{regiones_path}' (fuera de ellas, celdas de {GRID_DEG}°)")
+        for name, rings in polygons:
+            hit = points_in_rings(st_lat, st_lon, rings) & (zone == None)
+            zone[hit] = name
+    else:
+        print(f"ℹ️ Zonas: celdas de {GRID_DEG}° ('{regiones_path}' no existe)")
+    cell_lat = np.floor(st_lat / GRID_DEG) * GRID_DEG
+    cell_lon = np.floor(st_lon / GRID_DEG) * GRID_DEG
+    for i in np.flatnonzero(zone == None):
+        zone[i] = f"Celda {cell_lat[i]:.2f}, {cell_lon[i]:.2f}"
+    station_coords['zona'] = zone
+
+    # tipo de equipo: columna del CSV si existe; si no, según si la estación reporta PM2.5
+    cols_lower = {c.lower(): c for c in df.columns}
+    equipo_col = find_col_by_tokens(['tipo_equipo','tipo_estacion','equipo','equipment_type','device_type','modelo'], cols_lower)
+    if equipo_col:
+        equipo_by_station = df.groupby('estacion_id')[equipo_col].last()
+        equipo_by_station.index = equipo_by_station.index.astype(str)
+        station_coords['equipo'] = station_coords['estacion_id'].map(equipo_by_station).fillna('Sin tipo').astype(str)
+    else:
+        has_pm = df.groupby('estacion_id')[col_map['pm25']].count() > 0 if col_map.get('pm25') else pd.Series(dtype=bool)
+        has_pm.index = has_pm.index.astype(str)
+        station_coords['equipo'] = station_coords['estacion_id'].map(
+            lambda sid: 'Calidad del aire' if has_pm.get(sid, False) else 'Meteorológica'
+        )
+
+    return {
+        'df': df,
+        'col_map': col_map,
+        'hourly': hourly,
+        'rolling': rolling,
+        'episodes': episodes,
+        'station_coords': station_coords
+    }
+
+def spec_window(spec):
+    """(desde, hasta) de una salida; un 'hasta' sin hora (AAAA-MM-DD) incluye todo ese día."""
+    t0 = pd.Timestamp(spec['desde']) if spec.get('desde') else None
+    t1 = None
+    if spec.get('hasta'):
+        t1 = pd.Timestamp(spec['hasta'])
+        if len(str(spec['hasta']).strip()) == 10:
+            t1 = t1 + pd.Timedelta(days=1) - pd.Timedelta(microseconds=1)
+    return t0, t1
+
+def select_stations(ctx, spec):
+    """Estaciones de la salida según bbox [lat_min, lon_min, lat_max, lon_max] y/o región (zona o tipo de equipo)."""
+    sc = ctx['station_coords']
+    mask = np.ones(len(sc), dtype=bool)
+    if spec.get('bbox'):
+        lat_min, lon_min, lat_max, lon_max = [float(x) for x in spec['bbox']]
+        mask &= sc['latitud'].between(lat_min, lat_max).to_numpy() & sc['longitud'].between(lon_min, lon_max).to_numpy()
+    if spec.get('region'):
+        mask &= ((sc['zona'] == spec['region']) | (sc['equipo'] == spec['region'])).to_numpy()
+    return set(sc.loc[mask, 'estacion_id'])
+
+def build_payload(ctx, spec):
+    """Datos embebidos de una página para una salida {out, desde, hasta, bbox, region, variables}."""
+    df, col_map = ctx['df'], ctx['col_map']
+    t0, t1 = spec_window(spec)
+
+    # filas de la salida (ventana temporal + estaciones)
+    rows = np.ones(len(df), dtype=bool)
+    if t0 is not None:
+        rows &= (df['timestamp'] >= t0).to_numpy()
+    if t1 is not None:
+        rows &= (df['timestamp'] <= t1).to_numpy()
+    if spec.get('bbox') or spec.get('region'):
+        rows &= df['estacion_id'].astype(str).isin(select_stations(ctx, spec)).to_numpy()
+    sub = df[rows] if not rows.all() else df
+
+    # última lectura por estación
+    last_by_station = sub.groupby('estacion_id', as_index=False).last()
+    latest_records = []
+    for _, r in last_by_station.iterrows():
+        rec = {
+            'estacion_id': str(r.get('estacion_id')),
+            'nombre_estacion': r.get('nombre_estacion') if 'nombre_estacion' in r else None,
+            'latitud': float(r['latitud']),
+            'longitud': float(r['longitud']),
+            'timestamp': r['timestamp'].isoformat() if not pd.isna(r['timestamp']) else None
+        }
+        for key in mapping_tokens.keys():
+            col = col_map.get(key)
+            if col:
+                val = r.get(col)
+                try:
+                    rec[key] = None if pd.isna(val) else float(val)
+                except Exception:
+                    rec[key] = None
+            else:
+                rec[key] = None
+        if (rec.get('aqi') is None) and rec.get('pm25') not in (None,):
+            rec['aqi'] = pm25_to_aqi(rec.get('pm25'))
+        latest_records.append(rec)
+
+    # historiales: series horarias compartidas, recortadas a la ventana de la salida
+    station_histories = {}
+    station_lttb = {}
+    station_hours = {}
+    all_times_set = set()
+    for station_id in pd.Index(sub['estacion_id'].unique()).sort_values():
+        sid = str(station_id)
+        rec = {k: [] for k in vars_canonical}
+        res = ctx['hourly'].get(sid)
+        if res is not None and (t0 is not None or t1 is not None):
+            res = res[(res.index >= t0 if t0 is not None else True) & (res.index <= t1 if t1 is not None else True)]
+        if res is None or res.empty:
+            station_histories[sid] = rec
+            continue
+        timestamps = [ts.isoformat() for ts in res.index]
+        all_times_set.update(timestamps)
+        station_hours[sid] = res.index
+        for v in vars_canonical:
+            if v == 'timestamps':
+                continue
+            col = col_map.get(v)
+            if col:
+                vals = []
+                for val in res[col].tolist():
+                    vals.append(None if pd.isna(val) else float(val))
+                rec[v] = vals
+            else:
+                if v == 'aqi':
+                    pmvals = []
+                    pmcol = col_map.get('pm25')
+                    if pmcol and pmcol in res:
+                        for val in res[pmcol].tolist():
+                            pmvals.append(None if pd.isna(val) else pm25_to_aqi(val))
+                    rec[v] = pmvals if pmvals else [None]*len(timestamps)
+                else:
+                    rec[v] = [None]*len(timestamps)
+        # historia completa para el gráfico del panel cuando HIST la recorta a max_points: así el panel muestra
+        # siempre toda la historia de la estación (reducida con LTTB si es larga)
+        lttb_cols = {v: col_map[v] for v in lttb_vars if col_map.get(v)}
+        if lttb_cols and len(timestamps) > max_points:
+            levels, full = lttb_levels(res, lttb_cols)
+            if levels or full:
+                station_lttb[sid] = {'n': len(timestamps), 't0': timestamps[0], 'niveles': levels, 'completa': full}
+        if len(timestamps) > max_points:
+            timestamps = timestamps[-max_points:]
+            for k in rec:
+                if k == 'timestamps': continue
+                if rec[k]:
+                    rec[k] = rec[k][-max_points:]
+        rec['timestamps'] = timestamps
+        station_histories[sid] = rec
+
+    # NowCast / media 24 h precalculados sobre la matriz completa (la ventana no recorta su historia previa)
+    rolling = ctx['rolling']
+    for sid, rec in station_histories.items():
+        n = len(rec['timestamps'])
+        for v in rolling_vars:
+            if rolling and sid in rolling[v].columns and n:
+                hours = station_hours[sid][-n:]
+                rec[v] = [None if pd.isna(x) else round(float(x), 2) for x in rolling[v][sid].reindex(hours)]
+            else:
+                rec[v] = [None] * n
+    for rec in latest_records:
+        sid = rec['estacion_id']
+        for v in rolling_vars:
+            hist_vals = station_histories.get(sid, {}).get(v) or []
+            rec[v] = hist_vals[-1] if hist_vals else None
+
+    # ordenar all times
+    all_times = sorted(all_times_set, key=lambda x: datetime.fromisoformat(x)) if all_times_set else []
+
+    # estadísticas por estación (mean de columnas numéricas, n, rango temporal)
+    numeric_cols = sub.select_dtypes(include=['number']).columns.tolist()
+    numeric_cols = [c for c in numeric_cols if c not in ('latitud','longitud')]
+    station_stats = {}
+    for station_id, g in sub.groupby('estacion_id'):
+        stats = {}
+        gg = g.copy()
+        stats['n_muestras'] = int(len(gg))
+        stats['primera_lectura'] = gg['timestamp'].min().isoformat() if not gg['timestamp'].isna().all() else None
+        stats['ultima_lectura'] = gg['timestamp'].max().isoformat() if not gg['timestamp'].isna().all() else None
+        for col in numeric_cols:
+            try:
+                m = gg[col].dropna().mean()
+                stats[col] = None if pd.isna(m) else round(float(m), 2)
+            except Exception:
+                stats[col] = None
+        # asegurar que stats tenga canónicas (si no están calculadas, intentar promediar desde mapeos)
+        for v in ['pm25','temp','humidity','precip','aqi','pm1','pm10','wind_speed','pressure']:
+            if v not in stats or stats.get(v) is None:
+                col = col_map.get(v)
+                if col and col in gg:
+                    try:
+                        mv = gg[col].dropna().mean()
+                        stats[v] = None if pd.isna(mv) else round(float(mv), 2)
+                    except:
+                        stats[v] = None
+        # si no hay aqi en stats pero hay pm25 promedio, calcular
+        if (stats.get('aqi') in (None,)) and stats.get('pm25') not in (None,):
+            stats['aqi'] = pm25_to_aqi(stats.get('pm25'))
+        station_stats[str(station_id)] = stats
+
+    # Selección de hasta 10 campos relevantes para Detalles: priorizo indispensables y opcionales
+    selected_keys = []
+    for key in priority_order:
+        any_non_null = any((station_stats[sid].get(key) not in (None,) for sid in station_stats))
+        if any_non_null:
+            selected_keys.append(key)
+    # si quedaron menos de 10, añadir otras numeric cols (convertir a legible)
+    for col in numeric_cols:
+        if len(selected_keys) >= 10: break
+        if col.lower() in selected_keys:
+            continue
+        # tratar nombres no canónicos
+        if col not in selected_keys:
+            selected_keys.append(col)
+    selected_keys = selected_keys[:10]
+
+    # centro del mapa (si la ventana quedó vacía, el de todo el CSV)
+    center_src = sub if not sub.empty else df
+    center_lat = float(center_src['latitud'].mean())
+    center_lon = float(center_src['longitud'].mean())
+
+    # --- CALCULAR PROMEDIOS GLOBALES POR TIEMPO (para visualizaciones globales) ---
+    station_time_index = {}
+    for sid, rec in station_histories.items():
+        station_time_index[sid] = rec.get('timestamps', [])
+
+    global_averages = []
+    for t in all_times:
+        row = {'timestamp': t}
+        for v in global_vars:
+            vals = []
+            for sid, rec in station_histories.items():
+                ts_list = station_time_index.get(sid, [])
+                val = last_value_before(rec, ts_list, t, v)
+                if val is not None:
+                    try:
+                        f = float(val)
+                        if not pd.isna(f): vals.append(f)
+                    except:
+                        pass
+            row[v] = round(sum(vals)/len(vals), 2) if vals else None
+        global_averages.append(row)
+
+    # --- AGREGADOS POR REGIÓN Y POR TIPO DE EQUIPO ---
+    # matriz horaria (tiempo × estación) con la misma semántica que GLOBAL_AVG: valor de la última fila <= t.
+    # Los NaN de filas existentes se marcan con un centinela para que el ffill no los rellene con valores anteriores.
+    SENTINEL = np.inf
+    hist_frames = []
+    for sid, rec in station_histories.items():
+        if not rec.get('timestamps'):
+            continue
+        fr = pd.DataFrame({v: rec.get(v) or [None]*len(rec['timestamps']) for v in global_vars}, dtype=float)
+        fr['timestamp'] = rec['timestamps']
+        fr['estacion_id'] = sid
+        hist_frames.append(fr)
+
+    rollups = {'zona': {}, 'equipo': {}}
+    if hist_frames and all_times:
+        long_hist = pd.concat(hist_frames, ignore_index=True)
+        long_hist[global_vars] = long_hist[global_vars].fillna(SENTINEL)
+        wide = long_hist.pivot(index='timestamp', columns='estacion_id', values=global_vars)
+        wide = wide.reindex(all_times).ffill().replace(SENTINEL, np.nan)
+        filled = wide.stack(level='estacion_id', future_stack=True).reset_index()
+        filled = filled.rename(columns={'level_0': 'timestamp'})
+        station_coords = ctx['station_coords'][ctx['station_coords']['estacion_id'].isin(station_histories)]
+        groups = station_coords.melt(id_vars='estacion_id', value_vars=['zona','equipo'], var_name='grupo', value_name='region')
+        filled = filled.merge(groups, on='estacion_id')
+        gb = filled.groupby(['grupo','region','timestamp'])[global_vars]
+        agg = pd.concat({'mean': gb.mean(), 'count': gb.count(), 'p90': gb.quantile(0.9)}, axis=1)
+        for (grupo, region), block in agg.groupby(level=['grupo','region']):
+            block = block.droplevel(['grupo','region']).reindex(all_times)
+            # solo el tramo con alguna estación con datos; 'i0' = posición de su primera hora en ALL_TIMES
+            has_data = np.flatnonzero((block['count'].fillna(0) > 0).any(axis=1).to_numpy())
+            if not len(has_data):
+                continue
+            block = block.iloc[has_data[0]:has_data[-1] + 1]
+            entry = {'estaciones': sorted(groups.loc[(groups['grupo'] == grupo) & (groups['region'] == region), 'estacion_id'].tolist()),
+                     'i0': int(has_data[0])}
+            for v in global_vars:
+                entry[v] = {
+                    'mean': [None if pd.isna(x) else round(float(x), 2) for x in block[('mean', v)]],
+                    'count': [int(x) if not pd.isna(x) else 0 for x in block[('count', v)]],
+                    'p90': [None if pd.isna(x) else round(float(x), 2) for x in block[('p90', v)]]
+                }
+            rollups[grupo][region] = entry
+
+    print("ℹ️ Agregados regionales:", {g: len(r) for g, r in rollups.items()})
+
+    # índice compacto de episodios en columnas, ordenado por (posición en ALL_TIMES, estación, tipo);
+    # los episodios se detectan una vez sobre las matrices completas y aquí solo se filtran
+    # (solo los que caen en las horas que HIST emite para su estación; si no, el salto mostraría la estación sin datos)
+    ep = ctx['episodes']
+    time_pos = {t: i for i, t in enumerate(all_times)}
+    ep_iso = [t.isoformat() for t in ep['t']]
+    ep_pos = np.array([time_pos.get(t, -1) for t in ep_iso], dtype=int)
+    hist_hours = {sid: set(rec['timestamps']) for sid, rec in station_histories.items()}
+    keep = (ep_pos >= 0) & np.array([t in hist_hours.get(str(s), ()) for t, s in zip(ep_iso, ep['s'])], dtype=bool)
+    ep_s, ep_k, ep_v, ep_d, ep_pos = ep['s'][keep], ep['k'][keep], ep['v'][keep], ep['d'][keep], ep_pos[keep]
+    order = np.lexsort((ep_k, ep_s.astype(str), ep_pos))
+    events = {
+        'tipos': event_kinds,
+        't': ep_pos[order].tolist(),
+        's': [str(x) for x in ep_s[order]],
+        'k': ep_k[order].astype(int).tolist(),
+        'v': [None if pd.isna(x) else float(x) for x in ep_v[order]],
+        'd': [x if (x is None or isinstance(x, str)) else (None if pd.isna(x) else float(x)) for x in ep_d[order]]
+    }
+    print("ℹ️ Episodios detectados:", {k: events['k'].count(i) for i, k in enumerate(event_kinds)})
+
+    payload = {
+        'latest': latest_records,
+        'hist': station_histories,
+        'hist_lttb': station_lttb,
+        'stats': station_stats,
+        'all_times': all_times,
+        'global_avg': global_averages,
+        'rollups': rollups,
+        'events': events,
+        'selected_keys': selected_keys,
+        'center': (center_lat, center_lon)
+    }
+    if spec.get('variables'):
+        prune_variables(payload, spec['variables'], col_map)
+
+    print("ℹ️ Campos finales para Detalles (limitados, legibles):")
+    for k in payload['selected_keys']:
+        lab = label_map.get(k, k.replace('_',' '))
+        print("   -", k, "→", lab)
+    return payload
+
+def prune_variables(payload, variables, col_map):
+    """Deja en la página solo las variables pedidas (más sus derivadas NowCast/24 h si se pide pm25)."""
+    keep = set(variables) | ({'timestamps'} | (set(rolling_vars) if 'pm25' in variables else set()))
+    dropped = (set(vars_canonical) | set(rolling_vars)) - keep
+    # en STATS/Detalles: metadatos de la estación, las variables pedidas y sus columnas originales del CSV
+    keep_stats = {'n_muestras', 'primera_lectura', 'ultima_lectura'} | keep | {col_map[v] for v in keep if col_map.get(v)}
+    for stats in payload['stats'].values():
+        for k in [k for k in stats if k not in keep_stats]:
+            del stats[k]
+    payload['selected_keys'] = [k for k in payload['selected_keys'] if k in keep_stats]
+    for rec in payload['hist'].values():
+        for k in dropped:
+            rec.pop(k, None)
+    for rec in payload['latest']:
+        for k in dropped:
+            rec.pop(k, None)
+    for entry in payload['hist_lttb'].values():
+        for level in [*entry['niveles'].values(), entry['completa']]:
+            for k in dropped:
+                level.pop(k, None)
+    for row in payload['global_avg']:
+        for k in dropped:
+            row.pop(k, None)
+    for regions in payload['rollups'].values():
+        for entry in regions.values():
+            for k in dropped:
+                entry.pop(k, None)
+    ev = payload['events']
+    kind_var = {'umbral': 'pm25', 'pico': 'pm25', 'lluvia': 'precip'}
+    keep_ev = [i for i, k in enumerate(ev['k']) if kind_var[ev['tipos'][k]] in keep]
+    for col in ('t', 's', 'k', 'v', 'd'):
+        ev[col] = [ev[col][i] for i in keep_ev]
+
 # Template HTML (sidebar para Detalles). Mantengo Chart.js + adapter, parser seguro y formatos date-fns.
 # IMPORTANTE: todo el JS queda dentro de esta cadena triple-quoted para evitar errores de sintaxis en Python.
 template = """<!doctype html>
@@ -328,6 +844,7 @@ template = """<!doctype html>
 <!-- Controles compactos (izquierda superior) -->
 <div class="controls-panel" id="controls-panel">
   <div style="margin-bottom:6px"><strong id="global-title">Indicadores</strong></div>
+  <select id="view-select" class="btn" style="width:100%" title="Vista: global, zona o tipo de equipo"></select>
   <div style="margin-top:8px;display:flex;gap:6px;align-items:center">
     <button id="global-play" class="btn primary">Reproducir</button>
     <button id="global-pause" class="btn" disabled>Pausar</button>
@@ -337,6 +854,11 @@ template = """<!doctype html>
     <input id="time-slider" type="range" min="0" max="0" value="0" />
     <div class="small">Tiempo: <span id="time-label">—</span></div>
   </div>
+  <div style="margin-top:6px;display:flex;gap:6px;align-items:center">
+    <button id="event-prev" class="btn" title="Episodio anterior">◀ Evento</button>
+    <button id="event-next" class="btn" title="Siguiente episodio">Evento ▶</button>
+  </div>
+  <div class="small" id="event-label" style="margin-top:4px;max-width:240px"></div>
   <div class="global-visual" id="global-visual">
     <div class="vis-card" id="vis-pm25" title="PM2.5 — promedio global"><canvas id="cv-pm25" width="86" height="86"></canvas><div class="vis-label" id="vis-label-pm25">PM2.5 — Global</div></div>
     <div class="vis-card" id="vis-temp" title="Temperatura — promedio global"><canvas id="cv-temp" width="86" height="86"></canvas><div class="vis-label" id="vis-label-temp">Temperatura — Global</div></div>
@@ -382,15 +904,18 @@ template = """<!doctype html>
 <script src="https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.js"></script>
 <script src="https://cdnjs.cloudflare.com/ajax/libs/leaflet.markercluster/1.1.0/leaflet.markercluster.js"></script>
 <script src="https://cdn.jsdelivr.net/npm/chart.js@4.4.0/dist/chart.umd.min.js"></script>
-<script src="https://cdn.jsdelivr.net/npm/chartjs-adapter-date-fns@3"></script>
+<script src="https://cdn.jsdelivr.net/npm/chartjs-adapter-date-fns@3.0.0/dist/chartjs-adapter-date-fns.bundle.min.js"></script>
 
 <script>
 // DATOS EMBEBIDOS
 const LATEST = __LATEST_JSON__;
 const HIST = __HIST_JSON__;
+const HIST_LTTB = __HIST_LTTB_JSON__;
 const STATS = __STATS_JSON__;
 const ALL_TIMES = __ALL_TIMES_JSON__;
 const GLOBAL_AVG = __GLOBAL_AVG_JSON__;
+const ROLLUPS = __ROLLUPS_JSON__;
+const EVENTS = __EVENTS_JSON__;
 const CENTER = [__CENTER_LAT__, __CENTER_LON__];
 const VAR_LABELS = __LABELS_JSON__;
 const DETAIL_KEYS = __DETAIL_KEYS_JSON__;
@@ -413,12 +938,15 @@ function colorForPM(pm){
   return '#e74c3c';
 }
 
+// valor que colorea el mapa: NowCast de PM2.5 si existe, si no la media horaria
+function pmForColor(nowcast, pm){ return (nowcast === null || nowcast === undefined) ? pm : nowcast; }
+
 LATEST.forEach(st => {
   const lat = st.latitud; const lon = st.longitud;
   if (lat === null || lon === null) return;
-  const clr = colorForPM(st.pm25);
+  const clr = colorForPM(pmForColor(st.pm25_nowcast, st.pm25));
   const m = L.circleMarker([lat,lon], { radius:7, color: clr, fillColor: clr, fillOpacity:0.9, weight:1 });
-  const popup = `<div style="min-width:220px"><strong>${st.nombre_estacion || st.estacion_id}</strong><div class="small">⏱ ${st.timestamp || '—'}</div><div style="margin-top:6px"><button class="btn" onclick="openPanel('${encodeURIComponent(st.estacion_id)}')">Ver detalles</button></div></div>`;
+  const popup = `<div style="min-width:220px"><strong>${st.nombre_estacion || st.estacion_id}</strong><div class="small">⏱ ${st.timestamp || '—'}</div>${st.aqi_nowcast !== null && st.aqi_nowcast !== undefined ? `<div class="small">ICA NowCast: ${st.aqi_nowcast}</div>` : ''}<div style="margin-top:6px"><button class="btn" onclick="openPanel('${encodeURIComponent(st.estacion_id)}')">Ver detalles</button></div></div>`;
   m.bindPopup(popup);
   markerLayer.addLayer(m);
   markers[st.estacion_id] = { marker: m, latest: st };
@@ -434,12 +962,24 @@ const sidebarChartCtx = document.getElementById('sidebar-chart').getContext('2d'
 let sidebarChart = null;
 let focusedStation = null; // cuando está enfocado en una estación
 
+// historia completa de la estación para el gráfico: nivel LTTB más pequeño que cubre el ancho en píxeles (o el mayor
+// disponible) más las series cortas guardadas enteras; null si HIST ya tiene toda la historia.
+// Los puntos guardan horas desde entry.t0 ('h'), no timestamps completos.
+function pickLttbLevel(sid, px){
+  const entry = HIST_LTTB[sid];
+  if (!entry) return null;
+  const targets = Object.keys(entry.niveles).map(Number).sort((a,b)=>a-b);
+  const t = targets.find(x => x >= px) || targets[targets.length-1];
+  const series = Object.assign({}, entry.completa || {}, t !== undefined ? entry.niveles[String(t)] : {});
+  return { t0: new Date(entry.t0).getTime(), series: series };
+}
+
 function openPanel(encodedSid) {
   const sid = decodeURIComponent(encodedSid);
   const st = markers[sid] ? markers[sid].latest : null;
   if (!st) return;
   focusedStation = sid;
-  const clr = colorForPM(st.pm25);
+  const clr = colorForPM(pmForColor(st.pm25_nowcast, st.pm25));
   const panel = document.getElementById('floating-panel');
   panel.style.display = 'block';
   panel.style.borderLeft = `6px solid ${clr}`;
@@ -517,25 +1057,39 @@ function openPanel(encodedSid) {
     if (sidebarChart) { try { sidebarChart.destroy(); } catch(e){} sidebarChart = null; }
     return;
   }
-  const labels = rec.timestamps;
-  const ds1 = rec.pm25 || [];
-  const ds2 = rec.temp || [];
   if (sidebarChart) { try { sidebarChart.destroy(); } catch(e){} sidebarChart = null; }
-  sidebarChart = new Chart(sidebarChartCtx, {
-    type: 'line',
-    data: {
-      labels: labels,
+  // historia completa (HIST_LTTB, reducida según el ancho del canvas); sin entrada, HIST ya es toda la historia
+  const level = pickLttbLevel(sid, sidebarChartCtx.canvas.clientWidth);
+  let data, tension, animation;
+  if (level) {
+    const toXY = (s) => s ? s.h.map((h, i) => ({ x: level.t0 + h * 3600000, y: s.v[i] })) : [];
+    data = { datasets: [
+      { label: VAR_LABELS['pm25'] || 'PM2.5', data: toXY(level.series.pm25), spanGaps:true, yAxisID:'y1', tension:0, pointRadius:0, borderWidth:1.5 },
+      { label: VAR_LABELS['temp'] || 'Temperatura', data: toXY(level.series.temp), spanGaps:true, yAxisID:'y2', tension:0, pointRadius:0, borderWidth:1.5 }
+    ] };
+    tension = 0; animation = false;
+  } else {
+    data = {
+      labels: rec.timestamps,
       datasets: [
-        { label: VAR_LABELS['pm25'] || 'PM2.5', data: ds1, spanGaps:true, yAxisID:'y1', tension:0.3, pointRadius:0, borderWidth:1.5 },
-        { label: VAR_LABELS['temp'] || 'Temperatura', data: ds2, spanGaps:true, yAxisID:'y2', tension:0.3, pointRadius:0, borderWidth:1.5 }
+        { label: VAR_LABELS['pm25'] || 'PM2.5', data: rec.pm25 || [], spanGaps:true, yAxisID:'y1', tension:0.3, pointRadius:0, borderWidth:1.5 },
+        { label: VAR_LABELS['temp'] || 'Temperatura', data: rec.temp || [], spanGaps:true, yAxisID:'y2', tension:0.3, pointRadius:0, borderWidth:1.5 }
       ]
-    },
+    };
+    tension = 0.3; animation = { duration:250, easing:'easeOutCubic' };
+  }
+  sidebarChart = new Chart(sidebarChartCtx, {
+    type: 'line',
+    data: data,
     options: {
       maintainAspectRatio:false,
       responsive:true,
-      animation:{ duration:250, easing:'easeOutCubic' },
-      elements:{ line:{ tension:0.3 } },
-      interaction:{mode:'index', intersect:false},
+      animation: animation,
+      parsing: level ? false : true,
+      normalized: !!level,
+      elements:{ line:{ tension:tension } },
+      // con LTTB cada serie tiene sus propias horas: el tooltip busca el punto más cercano en x, no el mismo índice
+      interaction: level ? {mode:'nearest', axis:'x', intersect:false} : {mode:'index', intersect:false},
       plugins:{legend:{display:true}},
       scales: {
         x: { type:'time', time:{ parser: (v) => new Date(v), tooltipFormat:'yyyy-MM-dd HH:mm' } },
@@ -546,15 +1100,53 @@ function openPanel(encodedSid) {
   });
 }
 
+// vista agregada activa: null = promedio global; {grupo, region} = agregado precalculado en ROLLUPS
+let currentRollup = null;
+const GROUP_LABELS = { zona: 'Zona', equipo: 'Tipo de equipo' };
+
+function resetViewLabels() {
+  const suffix = currentRollup ? currentRollup.region : 'Global';
+  document.getElementById('global-title').textContent = currentRollup ? `${GROUP_LABELS[currentRollup.grupo]}: ${currentRollup.region}` : 'Indicadores';
+  document.getElementById('vis-label-pm25').textContent = `PM2.5 — ${suffix}`;
+  document.getElementById('vis-label-temp').textContent = `Temperatura — ${suffix}`;
+  document.getElementById('vis-label-humidity').textContent = `Humedad — ${suffix}`;
+  document.getElementById('vis-label-precip').textContent = `Precipitación — ${suffix}`;
+}
+
+const viewSelect = document.getElementById('view-select');
+(function buildViewSelect(){
+  const opt = document.createElement('option'); opt.value = ''; opt.textContent = 'Promedio global'; viewSelect.appendChild(opt);
+  for (const grupo of Object.keys(ROLLUPS)) {
+    const regions = Object.keys(ROLLUPS[grupo]).sort();
+    if (!regions.length) continue;
+    const og = document.createElement('optgroup'); og.label = GROUP_LABELS[grupo] || grupo;
+    regions.forEach(r => {
+      const o = document.createElement('option'); o.value = `${grupo}|${r}`;
+      o.textContent = `${r} (${ROLLUPS[grupo][r].estaciones.length})`; og.appendChild(o);
+    });
+    viewSelect.appendChild(og);
+  }
+})();
+viewSelect.onchange = () => {
+  const v = viewSelect.value;
+  if (!v) { currentRollup = null; }
+  else { const i = v.indexOf('|'); currentRollup = { grupo: v.slice(0, i), region: v.slice(i + 1) }; }
+  if (!focusedStation) resetViewLabels();
+};
+
+// valores (media, n, p90) del agregado activo en el índice de tiempo idx
+function rollupValuesAt(idx, field){
+  const r = ROLLUPS[currentRollup.grupo][currentRollup.region];
+  const j = idx - r.i0;  // las series empiezan en ALL_TIMES[r.i0]
+  const get = (k) => (r[k] && r[k][field] && j >= 0 && j < r[k][field].length) ? r[k][field][j] : null;
+  return { pm25: get('pm25'), temp: get('temp'), humidity: get('humidity'), precip: get('precip') };
+}
+
 document.getElementById('close-panel').onclick = () => {
   try { if (sidebarChart) sidebarChart.destroy(); } catch(e){}
   document.getElementById('floating-panel').style.display = 'none';
   focusedStation = null;
-  document.getElementById('global-title').textContent = 'Indicadores';
-  document.getElementById('vis-label-pm25').textContent = 'PM2.5 — Global';
-  document.getElementById('vis-label-temp').textContent = 'Temperatura — Global';
-  document.getElementById('vis-label-humidity').textContent = 'Humedad — Global';
-  document.getElementById('vis-label-precip').textContent = 'Precipitación — Global';
+  resetViewLabels();
 }
 
 // helper: binary search inside rec.timestamps para obtener valores hasta t_iso
@@ -586,7 +1178,7 @@ timeLabel.textContent = times.length ? times[0].replace('T',' ') : '—';
 function updateMarkersForTime(idx) {
   const t = times[idx];
   timeLabel.textContent = t ? t.replace('T',' ') : '—';
-  // colorear marcadores siempre por PM2.5
+  // colorear marcadores por PM2.5 NowCast (o PM2.5 horario si no hay NowCast)
   for (const sid in HIST) {
     const rec = HIST[sid];
     if (!rec || !rec.timestamps) continue;
@@ -596,7 +1188,7 @@ function updateMarkersForTime(idx) {
       const mid = Math.floor((lo+hi)/2);
       if (arr[mid] <= t) { j = mid; lo = mid + 1; } else hi = mid - 1;
     }
-    const val = j >= 0 ? (rec['pm25'] ? rec['pm25'][j] : null) : null;
+    const val = j >= 0 ? pmForColor(rec['pm25_nowcast'] ? rec['pm25_nowcast'][j] : null, rec['pm25'] ? rec['pm25'][j] : null) : null;
     const mobj = markers[sid];
     if (!mobj) continue;
     try { const clr = colorForPM(val); mobj.marker.setStyle({ color: clr, fillColor: clr }); } catch(e){}
@@ -625,6 +1217,37 @@ function stopGlobalPlay() {
   globalPlay.disabled = false; globalPause.disabled = true;
 }
 globalPlay.onclick = startGlobalPlay; globalPause.onclick = stopGlobalPlay;
+
+// Episodios: EVENTS.t (posiciones en ALL_TIMES) está ordenado; búsqueda binaria del primer evento con t > idx
+const eventLabel = document.getElementById('event-label');
+function firstEventAfter(idx){
+  let lo = 0, hi = EVENTS.t.length;
+  while (lo < hi){ const mid = (lo + hi) >> 1; if (EVENTS.t[mid] <= idx) lo = mid + 1; else hi = mid; }
+  return lo;
+}
+function describeEvent(i){
+  const sid = EVENTS.s[i], v = EVENTS.v[i], d = EVENTS.d[i];
+  const name = markers[sid] ? (markers[sid].latest.nombre_estacion || sid) : sid;
+  const kind = EVENTS.tipos[EVENTS.k[i]];
+  if (kind === 'umbral') return `${name}: PM2.5 ${v} µg/m³ pasa a «${d}»`;
+  if (kind === 'pico') return `${name}: pico de PM2.5 ${v} µg/m³ (base ${d})`;
+  return `${name}: lluvia fuerte ${v} mm`;
+}
+function seekEvent(dir){
+  if (!EVENTS.t.length) return;
+  // siguiente: primer evento después de la hora actual; anterior: último evento antes de ella
+  const i = dir > 0 ? firstEventAfter(timeIndex) : firstEventAfter(timeIndex - 1) - 1;
+  if (i < 0 || i >= EVENTS.t.length) return;
+  stopGlobalPlay();
+  timeIndex = EVENTS.t[i];
+  timeSlider.value = timeIndex;
+  updateMarkersForTime(timeIndex);
+  const first = firstEventAfter(timeIndex - 1), sameHour = firstEventAfter(timeIndex) - first;
+  eventLabel.textContent = `⚠ ${describeEvent(first)}${sameHour > 1 ? ` (+${sameHour - 1})` : ''}`;
+}
+document.getElementById('event-prev').onclick = () => seekEvent(-1);
+document.getElementById('event-next').onclick = () => seekEvent(1);
+if (!EVENTS.t.length){ document.getElementById('event-prev').disabled = true; document.getElementById('event-next').disabled = true; }
 if (times.length) updateMarkersForTime(0);
 
 // --- DIBUJO DE ICONOS ANIMADOS (funciones definidas aquí dentro del template) ---
@@ -760,6 +1383,8 @@ function getCurrentParamValue(param){
     if (!tIso) return null;
     const vals = getValuesForStationAtTime(focusedStation, tIso);
     return vals[param];
+  } else if (currentRollup) {
+    return rollupValuesAt(idx, 'mean')[param];
   } else {
     const g = GLOBAL_AVG[idx] || {};
     return g[param];
@@ -772,7 +1397,12 @@ function getCurrentParamValue(param){
     let v = getCurrentParamValue(param);
     let disp = (v===null||v===undefined)? '—' : v;
     if (param==='pm25' && (v===null||v===undefined)) disp = '— (asumido limpio)';
-    const txt = `${(param==='pm25')? 'PM2.5': (param==='temp')? 'Temperatura': (param==='humidity')? 'Humedad': 'Precipitación'}: ${disp} ${unit}`;
+    let txt = `${(param==='pm25')? 'PM2.5': (param==='temp')? 'Temperatura': (param==='humidity')? 'Humedad': 'Precipitación'}: ${disp} ${unit}`;
+    if (!focusedStation && currentRollup){
+      const idx = Math.max(0, Math.min(GLOBAL_AVG.length-1, timeIndex));
+      const n = rollupValuesAt(idx, 'count')[param], p90 = rollupValuesAt(idx, 'p90')[param];
+      txt += ` (n=${n || 0}${p90 !== null && p90 !== undefined ? `, p90=${p90}` : ''})`;
+    }
     showTooltip(txt, ev.clientX, ev.clientY);
   });
   c.addEventListener('mouseleave', hideTooltip);
@@ -780,7 +1410,8 @@ function getCurrentParamValue(param){
 
 function animLoop(){
   const idx = Math.max(0, Math.min(GLOBAL_AVG.length-1, timeIndex));
-  const g = focusedStation ? getValuesForStationAtTime(focusedStation, ALL_TIMES[timeIndex]) : GLOBAL_AVG[idx] || {};
+  const g = focusedStation ? getValuesForStationAtTime(focusedStation, ALL_TIMES[timeIndex])
+    : currentRollup ? rollupValuesAt(idx, 'mean') : GLOBAL_AVG[idx] || {};
   drawGlobalVisual(g);
   requestAnimationFrame(animLoop);
 }
@@ -791,21 +1422,236 @@ requestAnimationFrame(animLoop);
 </html>
 """
 
-# reemplazos JSON y guardado
-html = template.replace("__LATEST_JSON__", json.dumps(latest_records, ensure_ascii=False))
-html = html.replace("__HIST_JSON__", json.dumps(station_histories, ensure_ascii=False))
-html = html.replace("__STATS_JSON__", json.dumps(station_stats, ensure_ascii=False))
-html = html.replace("__ALL_TIMES_JSON__", json.dumps(all_times, ensure_ascii=False))
-html = html.replace("__GLOBAL_AVG_JSON__", json.dumps(global_averages, ensure_ascii=False))
-html = html.replace("__LABELS_JSON__", json.dumps(label_map, ensure_ascii=False))
-html = html.replace("__DETAIL_KEYS_JSON__", json.dumps(selected_keys, ensure_ascii=False))
-html = html.replace("__CENTER_LAT__", f"{center_lat:.6f}")
-html = html.replace("__CENTER_LON__", f"{center_lon:.6f}")
-html = html.replace("__LEGEND_JSON__", json.dumps(legend, ensure_ascii=False))
-
-with open(OUT, "w", encoding="utf-8") as f:
-    f.write(html)
-
-size_kb = os.path.getsize(OUT)/1024
-print(f"✅ HTML v4.4 generado: {OUT} ({size_kb:.1f} KB)")
-print("Servir: python3 -m http.server 8000  y abrir http://localhost:8000/" + OUT)
+def render_page(payload, compact=False):
+    """Reemplaza los marcadores del template con los datos de la página (JSON sin espacios si compact)."""
+    separators = (',', ':') if compact else None
+    def dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=separators)
+    center_lat, center_lon = payload['center']
+    html = template.replace("__LATEST_JSON__", dumps(payload['latest']))
+    html = html.replace("__HIST_JSON__", dumps(payload['hist']))
+    html = html.replace("__HIST_LTTB_JSON__", dumps(payload['hist_lttb']))
+    html = html.replace("__STATS_JSON__", dumps(payload['stats']))
+    html = html.replace("__ALL_TIMES_JSON__", dumps(payload['all_times']))
+    html = html.replace("__GLOBAL_AVG_JSON__", dumps(payload['global_avg']))
+    html = html.replace("__ROLLUPS_JSON__", dumps(payload['rollups']))
+    html = html.replace("__EVENTS_JSON__", dumps(payload['events']))
+    html = html.replace("__LABELS_JSON__", dumps(label_map))
+    html = html.replace("__DETAIL_KEYS_JSON__", dumps(payload['selected_keys']))
+    html = html.replace("__CENTER_LAT__", f"{center_lat:.6f}")
+    html = html.replace("__CENTER_LON__", f"{center_lon:.6f}")
+    html = html.replace("__LEGEND_JSON__", dumps(legend))
+    return html
+
+# --- MODO BUNDLE: página autocontenida, minificada y precomprimida ---
+def write_bytes_atomic(path, data):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def write_precompressed(path, data):
+    """Escribe path.gz (y path.br si está instalado brotli) junto al archivo; deterministas (mtime=0)."""
+    write_bytes_atomic(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli is not None:
+        write_bytes_atomic(path + '.br', brotli.compress(data, quality=11))
+
+def fetch_vendor_assets(vendor_dir=VENDOR_DIR):
+    """Descarga una sola vez los recursos de VENDOR_ASSETS a vendor_dir (sin red: copiarlos ahí a mano) y verifica
+    el sha256 de cada uno, también de los que ya estaban en la caché."""
+    os.makedirs(vendor_dir, exist_ok=True)
+    errors = []
+    for name, url, sha256 in VENDOR_ASSETS:
+        path = os.path.join(vendor_dir, name)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                data = f.read()
+        else:
+            print(f" Descargando {url} ...")
+            try:
+                with urllib.request.urlopen(url, timeout=30) as r:
+                    data = r.read()
+            except Exception as e:
+                print(f"ERROR: no se pudo descargar '{url}' ({e}). Cópielo manualmente en '{path}'.", file=sys.stderr)
+                sys.exit(1)
+        digest = hashlib.sha256(data).hexdigest()
+        if sha256 is None:
+            errors.append(f"'{name}' no tiene sha256 fijado en VENDOR_ASSETS; el archivo obtenido de {url} tiene "
+                          f"sha256 {digest} (verifíquelo y anótelo)")
+            continue
+        if digest != sha256:
+            errors.append(f"'{name}' no coincide con el sha256 esperado ({digest} != {sha256}); "
+                          f"borre '{path}' y vuelva a descargarlo desde {url}")
+            continue
+        if not os.path.exists(path):
+            write_bytes_atomic(path, data)
+    if errors:
+        for err in errors:
+            print(f"ERROR: {err}", file=sys.stderr)
+        sys.exit(1)
+
+def minify_html(html):
+    """Minificación conservadora por líneas: quita sangrías, líneas vacías y comentarios de línea completa."""
+    lines = []
+    for line in html.splitlines():
+        line = line.strip()
+        if not line or line.startswith('//') or (line.startswith('<!--') and line.endswith('-->')):
+            continue
+        lines.append(line)
+    return '\n'.join(lines) + '\n'
+
+def bundle_assets(html, mode, out, vendor_dir=VENDOR_DIR):
+    """Sustituye las etiquetas CDN del template: 'inline' incrusta los recursos en la página; 'local' los copia
+    a assets/ junto al HTML con el hash del contenido en el nombre (caché de larga duración) y su .gz/.br."""
+    assets_dir = os.path.join(os.path.dirname(out), 'assets')
+    manifest = {}
+    for name, url, _ in VENDOR_ASSETS:
+        with open(os.path.join(vendor_dir, name), 'rb') as f:
+            data = f.read()
+        is_css = name.endswith('.css')
+        tag = f'<link rel="stylesheet" href="{url}"/>' if is_css else f'<script src="{url}"></script>'
+        if tag not in html:
+            raise ValueError(f"el template no contiene la etiqueta de '{name}'")
+        if mode == 'inline':
+            text = data.decode('utf-8')
+            if is_css:
+                new_tag = "<style>" + text.replace('</style', '<\\/style') + "</style>"
+            else:
+                new_tag = "<script>" + text.replace('</script', '<\\/script') + "</script>"
+        else:
+            digest = hashlib.sha256(data).hexdigest()
+            stem, ext = os.path.splitext(name)
+            hashed = f"{stem}.{digest[:10]}{ext}"
+            os.makedirs(assets_dir, exist_ok=True)
+            path = os.path.join(assets_dir, hashed)
+            if not os.path.exists(path):
+                write_bytes_atomic(path, data)
+                write_precompressed(path, data)
+            manifest[name] = {'file': f"assets/{hashed}", 'sha256': digest, 'bytes': len(data)}
+            new_tag = (f'<link rel="stylesheet" href="assets/{hashed}"/>' if is_css
+                       else f'<script src="assets/{hashed}"></script>')
+        html = html.replace(tag, new_tag)
+    if manifest:
+        write_bytes_atomic(os.path.join(assets_dir, 'manifest.json'),
+                           json.dumps(manifest, indent=2, ensure_ascii=False).encode('utf-8'))
+    return html
+
+def generate_page(ctx, spec):
+    """Construye y guarda una página; devuelve (ruta, tamaño en KB)."""
+    out = spec['out']
+    bundle = spec.get('bundle')
+    html = render_page(build_payload(ctx, spec), compact=bool(bundle))
+    if os.path.dirname(out):
+        os.makedirs(os.path.dirname(out), exist_ok=True)
+    if bundle:
+        html = bundle_assets(minify_html(html), bundle, out, spec.get('vendor_dir', VENDOR_DIR))
+    with open(out, "w", encoding="utf-8") as f:
+        f.write(html)
+    size_kb = os.path.getsize(out)/1024
+    if bundle:
+        with open(out, 'rb') as f:
+            write_precompressed(out, f.read())
+        gz_kb = os.path.getsize(out + '.gz')/1024
+        print(f"✅ HTML v4.4 generado: {out} ({size_kb:.1f} KB, bundle {bundle}, gzip {gz_kb:.1f} KB)")
+    else:
+        print(f"✅ HTML v4.4 generado: {out} ({size_kb:.1f} KB)")
+    return out, size_kb
+
+# --- MODO LOTE: varias páginas desde un solo CSV cargado ---
+# manifest JSON: {"csv": "...", "salidas": [{"out": "...", "desde": "...", "hasta": "...",
+#                 "bbox": [lat_min, lon_min, lat_max, lon_max], "region": "...", "variables": ["pm25", ...]}]}
+# (también se acepta directamente la lista de salidas)
+_worker_ctx = None
+
+def _init_worker(ctx):
+    global _worker_ctx
+    _worker_ctx = ctx
+
+def _generate_in_worker(spec):
+    return generate_page(_worker_ctx, spec)
+
+def load_manifest(path, default_csv):
+    with open(path, encoding='utf-8') as f:
+        manifest = json.load(f)
+    if isinstance(manifest, list):
+        return default_csv, manifest
+    return manifest.get('csv', default_csv), manifest.get('salidas', [])
+
+def validate_specs(specs):
+    """Revisa el manifest antes de leer el CSV (las regiones se revisan después, en validate_regions)."""
+    known_vars = set(vars_canonical) | set(rolling_vars)
+    for i, spec in enumerate(specs):
+        if not spec.get('out'):
+            print(f"ERROR: la salida #{i+1} del manifest no tiene 'out'.", file=sys.stderr)
+            sys.exit(1)
+        try:
+            spec_window(spec)
+        except ValueError:
+            print(f"ERROR: fechas 'desde'/'hasta' inválidas en '{spec['out']}'.", file=sys.stderr)
+            sys.exit(1)
+        if spec.get('bbox') and len(spec['bbox']) != 4:
+            print(f"ERROR: bbox de '{spec['out']}' debe ser [lat_min, lon_min, lat_max, lon_max].", file=sys.stderr)
+            sys.exit(1)
+        if spec.get('bundle') not in (None, 'inline', 'local'):
+            print(f"ERROR: bundle de '{spec['out']}' debe ser 'inline' o 'local'.", file=sys.stderr)
+            sys.exit(1)
+        unknown = set(spec.get('variables') or []) - known_vars
+        if unknown:
+            print(f"ERROR: variables desconocidas {sorted(unknown)} en '{spec['out']}'.", file=sys.stderr)
+            sys.exit(1)
+
+def validate_regions(ctx, specs):
+    regions = set(ctx['station_coords']['zona']) | set(ctx['station_coords']['equipo'])
+    for spec in specs:
+        if spec.get('region') and spec['region'] not in regions:
+            print(f"ERROR: región desconocida '{spec['region']}' en '{spec['out']}'. Disponibles: {sorted(regions)}", file=sys.stderr)
+            sys.exit(1)
+
+def run_batch(ctx, specs, jobs=1):
+    """Genera todas las salidas con el contexto compartido; en paralelo (procesos) si jobs > 1."""
+    if jobs <= 1 or len(specs) <= 1:
+        return [generate_page(ctx, spec) for spec in specs]
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(ctx,)) as ex:
+        return list(ex.map(_generate_in_worker, specs))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Genera el mapa HTML de la red RACiMo a partir del CSV consolidado.")
+    parser.add_argument('--csv', default=CSV, help=f"CSV de entrada (por defecto {CSV})")
+    parser.add_argument('--out', default=OUT, help=f"HTML de salida (por defecto {OUT})")
+    parser.add_argument('--batch', metavar='MANIFEST', help="JSON con varias salidas (ventana, bbox/región, variables, ruta)")
+    parser.add_argument('--jobs', type=int, default=1, help="procesos para generar las páginas del lote en paralelo")
+    parser.add_argument('--bundle', choices=['inline', 'local'],
+                        help="página sin CDN: recursos incrustados (inline) o en assets/ con hash (local); JSON compacto y .gz/.br")
+    parser.add_argument('--vendor-dir', default=VENDOR_DIR, help="caché local de Leaflet, markercluster y Chart.js")
+    parser.add_argument('--regiones', default=REGIONES, help="GeoJSON de zonas para los agregados (si no existe, celdas de la grilla)")
+    args = parser.parse_args(argv)
+
+    if args.batch:
+        csv_path, specs = load_manifest(args.batch, args.csv)
+    else:
+        csv_path, specs = args.csv, [{'out': args.out}]
+
+    for spec in specs:
+        if args.bundle:
+            spec.setdefault('bundle', args.bundle)
+        spec.setdefault('vendor_dir', args.vendor_dir)
+    validate_specs(specs)
+    if any(spec.get('bundle') for spec in specs):
+        fetch_vendor_assets(args.vendor_dir)
+        if brotli is None:
+            print("⚠️ brotli no está instalado: se omiten las variantes .br y los clientes solo recibirán .gz "
+                  "(pip install brotli)", file=sys.stderr)
+
+    df, col_map = load_dataset(csv_path)
+    ctx = prepare_context(df, col_map, args.regiones)
+    validate_regions(ctx, specs)
+    results = run_batch(ctx, specs, args.jobs)
+
+    if not args.batch:
+        print("Servir: python3 -m http.server 8000  y abrir http://localhost:8000/" + results[0][0])
+    else:
+        print(f"✅ Lote: {len(results)} páginas generadas")
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""Arnés de equivalencia para mapa_generator.py.
+
+Extrae los datos embebidos (LATEST, HIST, STATS, GLOBAL_AVG, ROLLUPS, EVENTS, ...) de una página generada y los
+compara con una corrida de referencia ("golden") con tolerancia numérica y reglas de equivalencia
+de nulos. Sirve para validar de una sola vez velocidad y resultados de cada motor nuevo
+(vectorizado, paralelo, ...) sobre el dataset sintético y el real.
+
+  python3 verificar_golden.py --save-golden                 # guarda la referencia con el motor actual
+  python3 verificar_golden.py --engine otro_generador.py    # compara otro motor contra la referencia
+  python3 verificar_golden.py --compare a.html b.html       # compara dos páginas ya generadas
+
+Con el motor por defecto, cada corrida de comparación verifica además que el NowCast incremental (rolling_aqi_append) coincida
+hora a hora con el cálculo completo (rolling_aqi).
+"""
+
+import argparse
+import json
+import math
+import os, sys
+import re
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REAL_CSV = os.path.join(HERE, "datos_consolidados_20251104_141743.csv")
+GOLDEN_DIR = os.path.join(HERE, "golden")
+DEFAULT_PAYLOADS = ['LATEST', 'HIST', 'HIST_LTTB', 'STATS', 'ALL_TIMES', 'GLOBAL_AVG', 'ROLLUPS', 'EVENTS']
+
+# --- extracción de datos embebidos ---
+PAYLOAD_RE = re.compile(r'^const (\w+) = (.*);$', re.M)
+
+def extract_payloads(html):
+    """{NOMBRE: valor} para cada `const NOMBRE = <json>;` del script embebido."""
+    out = {}
+    for name, raw in PAYLOAD_RE.findall(html):
+        try:
+            out[name] = json.loads(raw)
+        except ValueError:
+            continue  # constantes JS que no son JSON (p. ej. CENTER, map)
+    return out
+
+def load_payloads(path):
+    with open(path, encoding='utf-8') as f:
+        return extract_payloads(f.read())
+
+# --- comparación ---
+# Reglas: null ≡ NaN; clave ausente ≡ null ≡ lista con solo nulos (pero lista vs lista siempre compara el largo,
+# el JS indexa por posición); números con |a-b| <= atol + rtol·|b|;
+# claves extra del candidato solo se aceptan si son nulas o con allow_extra.
+def is_null(v):
+    return v is None or (isinstance(v, float) and math.isnan(v))
+
+def is_all_null(v):
+    if isinstance(v, list):
+        return all(is_all_null(x) for x in v)
+    return is_null(v)
+
+def compare(golden, cand, rtol=1e-6, atol=1e-9, allow_extra=False, path='', diffs=None, limit=50):
+    if diffs is None:
+        diffs = []
+    if len(diffs) >= limit:
+        return diffs
+    if (is_null(golden) and is_all_null(cand)) or (is_null(cand) and is_all_null(golden)):
+        return diffs
+    if isinstance(golden, bool) or isinstance(cand, bool):
+        if golden is not cand:
+            diffs.append((path, golden, cand))
+        return diffs
+    if isinstance(golden, (int, float)) and isinstance(cand, (int, float)):
+        if is_null(golden) or is_null(cand) or abs(golden - cand) > atol + rtol * abs(golden):
+            diffs.append((path, golden, cand))
+        return diffs
+    if isinstance(golden, dict) and isinstance(cand, dict):
+        for k in golden:
+            compare(golden[k], cand.get(k), rtol, atol, allow_extra, f"{path}.{k}", diffs, limit)
+        for k in cand:
+            if k not in golden and not allow_extra and not is_all_null(cand[k]):
+                diffs.append((f"{path}.{k}", '<ausente>', cand[k]))
+        return diffs
+    if isinstance(golden, list) and isinstance(cand, list):
+        if len(golden) != len(cand):
+            diffs.append((f"{path}[len]", len(golden), len(cand)))
+            return diffs
+        for i, (a, b) in enumerate(zip(golden, cand)):
+            compare(a, b, rtol, atol, allow_extra, f"{path}[{i}]", diffs, limit)
+        return diffs
+    if golden != cand:
+        diffs.append((path, golden, cand))
+    return diffs
+
+def compare_pages(golden_path, cand_path, payloads, rtol, atol, allow_extra, limit=50):
+    g, c = load_payloads(golden_path), load_payloads(cand_path)
+    diffs = []
+    for name in payloads:
+        if name not in g:
+            continue
+        if name not in c:
+            diffs.append((name, '<presente>', '<ausente>'))
+            continue
+        compare(g[name], c[name], rtol, atol, allow_extra, name, diffs, limit)
+    return diffs
+
+def short(v, n=80):
+    s = json.dumps(v, ensure_ascii=False) if not isinstance(v, str) else v
+    return s if len(s) <= n else s[:n] + '…'
+
+def report(label, diffs, limit=50):
+    if not diffs:
+        print(f"  ✅ {label}: equivalente")
+        return True
+    print(f"  ❌ {label}: {'al menos ' if len(diffs) >= limit else ''}{len(diffs)} diferencias")
+    for path, a, b in diffs[:20]:
+        print(f"     {path}: golden={short(a)} candidato={short(b)}")
+    return False
+
+# --- datasets ---
+def synthetic_csv(path, n_stations=8, days=30, seed=7):
+    """CSV sintético determinista con el esquema del consolidado RACiMo: huecos, NaN,
+    estaciones sin PM2.5, picos de PM2.5 y rachas de lluvia."""
+    rng = np.random.default_rng(seed)
+    t = pd.date_range("2025-09-01", periods=days * 24 * 4, freq="15min")
+    frames = []
+    for k in range(n_stations):
+        has_pm = k % 2 == 1
+        i = np.arange(len(t))
+        fr = pd.DataFrame({
+            'timestamp': t.strftime('%Y-%m-%dT%H:%M:%S'),
+            'estacion_id': 219660 + k,
+            'nombre_estacion': f"RACiMo Sintetica{k}",
+            'latitud': round(5.9 + 0.17 * k, 6),
+            'longitud': round(-73.9 + 0.13 * k, 6),
+            'temp_ext_ult_C': 24 + 6 * np.sin(2 * np.pi * i / 96 + k) + rng.normal(0, 0.8, len(t)),
+            'hum_ext_ult': np.clip(70 + 15 * np.sin(2 * np.pi * i / 96 + k + 2) + rng.normal(0, 3, len(t)), 5, 100),
+            'lluvia_mm': np.where(rng.random(len(t)) < 0.03, rng.gamma(1.5, 4, len(t)), 0.0),
+            'pm_2p5_media_ugm3': (np.abs(9 + 7 * np.sin(i / 70 + k) + rng.normal(0, 2.5, len(t)))
+                                  + np.where(i % 700 < 6, 50, 0)) if has_pm else np.nan,
+            'viento_vel_media_kmh': np.abs(rng.normal(4, 2, len(t))),
+            'presion_absoluta_hPa': 1010 + rng.normal(0, 1.5, len(t)),
+        })
+        fr = fr[rng.random(len(fr)) > 0.04]  # lecturas perdidas
+        fr.loc[fr.sample(frac=0.02, random_state=seed + k).index, 'temp_ext_ult_C'] = np.nan
+        frames.append(fr)
+    pd.concat(frames, ignore_index=True).round(4).to_csv(path, index=False)
+    return path
+
+def is_lfs_pointer(path):
+    with open(path, 'rb') as f:
+        return f.read(40).startswith(b'version https://git-lfs')
+
+def resolve_datasets(names, workdir, scale):
+    out = {}
+    for name in names:
+        if name == 'sintetico':
+            out[name] = synthetic_csv(os.path.join(workdir, 'sintetico.csv'),
+                                      n_stations=8 * scale, days=30 * scale)
+        elif name == 'real':
+            if not os.path.exists(REAL_CSV) or is_lfs_pointer(REAL_CSV):
+                print(f"ℹ️ dataset real no disponible ('{os.path.basename(REAL_CSV)}' falta o es un puntero LFS); se omite")
+                continue
+            out[name] = REAL_CSV
+        else:
+            out[os.path.splitext(os.path.basename(name))[0]] = os.path.abspath(name)
+    return out
+
+# --- NowCast incremental ---
+def check_rolling_append(hours=400, n_stations=6, seed=11, rtol=1e-9, atol=1e-9):
+    """Agrega hora por hora con mapa_generator.rolling_aqi_append y compara cada fila con rolling_aqi sobre la
+    matriz completa. Incluye horas ausentes (huecos), NaN sueltos, una estación que aparece a mitad de serie, horas
+    que llegan en dos partes y una hora atrasada (debe rechazarse con ValueError)."""
+    sys.path.insert(0, HERE)
+    import mapa_generator as mg
+    rng = np.random.default_rng(seed)
+    idx = pd.date_range("2025-09-01", periods=hours, freq="h")
+    M = np.abs(12 + 8 * np.sin(np.arange(hours)[:, None] / 9 + np.arange(n_stations)) + rng.normal(0, 3, (hours, n_stations)))
+    M[rng.random(M.shape) < 0.08] = np.nan
+    M[:hours // 3, -1] = np.nan
+    M[rng.random(hours) < 0.05] = np.nan  # horas sin ninguna lectura: no llegan al append
+    full = pd.DataFrame(M, index=idx, columns=[str(219660 + k) for k in range(n_stations)])
+    expected = mg.rolling_aqi(full)
+    tail = pd.DataFrame(dtype=float)
+    diffs = []
+    for t, row in full.iterrows():
+        row = row.dropna()
+        if row.empty:
+            continue
+        if len(row) > 1 and t.hour % 5 == 0:  # la hora llega en dos partes: la segunda repite t
+            tail, _ = mg.rolling_aqi_append(tail, row.iloc[:len(row) // 2], t)
+            row = row.iloc[len(row) // 2:]
+        tail, got = mg.rolling_aqi_append(tail, row, t)
+        for v, series in got.items():
+            exp = expected[v].loc[t].reindex(series.index).to_numpy(dtype=float)
+            val = series.to_numpy(dtype=float)
+            bad = ~np.isclose(val, exp, rtol=rtol, atol=atol, equal_nan=True)
+            diffs.extend((f"{v}[{t.isoformat()}][{sid}]", e, g) for sid, e, g in zip(series.index[bad], exp[bad], val[bad]))
+    diffs = [(p, None if np.isnan(a) else float(a), None if np.isnan(b) else float(b)) for p, a, b in diffs]
+    late = idx[-5]  # lectura atrasada: anterior a la última hora de la cola
+    try:
+        mg.rolling_aqi_append(tail, full.loc[late].dropna(), late)
+        diffs.append((f"hora atrasada {late.isoformat()}", 'ValueError', 'aceptada'))
+    except ValueError:
+        pass
+    return report("rolling_aqi_append ≡ rolling_aqi", diffs, limit=len(diffs) + 1)
+
+# --- ejecución de motores ---
+def run_engine(engine, csv_path, out_path, extra_args=()):
+    """Ejecuta `python ENGINE --csv CSV --out OUT`; devuelve segundos de pared o None si el motor falla."""
+    t0 = time.perf_counter()
+    proc = subprocess.run([sys.executable, os.path.abspath(engine), '--csv', os.path.abspath(csv_path),
+                           '--out', os.path.abspath(out_path), *extra_args],
+                          cwd=HERE, capture_output=True, text=True)
+    elapsed = time.perf_counter() - t0
+    if proc.returncode != 0:
+        print(proc.stdout[-2000:], proc.stderr[-4000:], sep='\n', file=sys.stderr)
+        print(f"ERROR: el motor '{engine}' falló con código {proc.returncode}", file=sys.stderr)
+        return None
+    return elapsed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compara las salidas de mapa_generator.py contra una corrida golden.")
+    parser.add_argument('--engine', default=os.path.join(HERE, 'mapa_generator.py'), help="generador a evaluar (acepta --csv/--out)")
+    parser.add_argument('--engine-args', nargs=argparse.REMAINDER, default=[], help="argumentos extra para el motor (al final)")
+    parser.add_argument('--datasets', nargs='+', default=['sintetico', 'real'], help="'sintetico', 'real' o rutas a CSV")
+    parser.add_argument('--scale', type=int, default=1, help="multiplica estaciones y días del dataset sintético")
+    parser.add_argument('--golden-dir', default=GOLDEN_DIR)
+    parser.add_argument('--save-golden', action='store_true', help="guarda la salida del motor como referencia")
+    parser.add_argument('--compare', nargs=2, metavar=('GOLDEN', 'CANDIDATO'), help="compara dos páginas HTML ya generadas")
+    parser.add_argument('--payloads', nargs='+', default=DEFAULT_PAYLOADS, help="constantes embebidas a comparar")
+    parser.add_argument('--rtol', type=float, default=1e-6)
+    parser.add_argument('--atol', type=float, default=1e-9)
+    parser.add_argument('--allow-extra', action='store_true', help="acepta claves nuevas no nulas en el candidato")
+    args = parser.parse_args(argv)
+    # el motor corre con cwd=HERE: las rutas relativas se resuelven desde donde se invoca el arnés
+    args.engine = os.path.abspath(args.engine)
+    args.golden_dir = os.path.abspath(args.golden_dir)
+
+    if args.compare:
+        ok = report(os.path.basename(args.compare[1]),
+                    compare_pages(*args.compare, args.payloads, args.rtol, args.atol, args.allow_extra))
+        return 0 if ok else 1
+
+    os.makedirs(args.golden_dir, exist_ok=True)
+    all_ok = True
+    if not args.save_golden:
+        if args.engine == os.path.join(HERE, 'mapa_generator.py'):
+            print("🔁 NowCast incremental (mapa_generator.rolling_aqi_append):")
+            all_ok &= check_rolling_append()
+        else:
+            print(f"ℹ️ NowCast incremental no verificado: solo se revisa rolling_aqi_append de mapa_generator.py, "
+                  f"no el de '{os.path.basename(args.engine)}'")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, csv_path in resolve_datasets(args.datasets, tmp, args.scale).items():
+            golden_html = os.path.join(args.golden_dir, f"{name}.html")
+            golden_meta = os.path.join(args.golden_dir, f"{name}.json")
+            if args.save_golden:
+                secs = run_engine(args.engine, csv_path, golden_html, args.engine_args)
+                if secs is None:
+                    all_ok = False
+                    continue
+                with open(golden_meta, 'w', encoding='utf-8') as f:
+                    json.dump({'engine': os.path.basename(args.engine), 'segundos': secs, 'scale': args.scale}, f)
+                print(f"💾 {name}: golden guardado en {golden_html} ({secs:.2f} s)")
+                continue
+            if not os.path.exists(golden_html) or not os.path.exists(golden_meta):
+                print(f"ERROR: no hay golden completo para '{name}' (faltan {golden_html} o {golden_meta}); "
+                      f"ejecute primero con --save-golden.", file=sys.stderr)
+                all_ok = False
+                continue
+            with open(golden_meta, encoding='utf-8') as f:
+                meta = json.load(f)
+            # --scale cambia el dataset sintético: comparar contra un golden de otra escala no tiene sentido
+            if name == 'sintetico' and meta.get('scale', 1) != args.scale:
+                print(f"ERROR: el golden de '{name}' es de --scale {meta.get('scale', 1)} y se pidió --scale {args.scale}; "
+                      f"use la misma escala o guarde otro golden con --save-golden --golden-dir.", file=sys.stderr)
+                all_ok = False
+                continue
+            cand_html = os.path.join(tmp, f"{name}.html")
+            secs = run_engine(args.engine, csv_path, cand_html, args.engine_args)
+            if secs is None:
+                print(f"  ❌ {name}: el motor no generó la página")
+                all_ok = False
+                continue
+            speed = f"{secs:.2f} s (golden {meta['segundos']:.2f} s, ×{meta['segundos'] / secs:.2f})" if secs > 0 else f"{secs:.2f} s"
+            print(f"⏱ {name}: {speed}")
+            diffs = compare_pages(golden_html, cand_html, args.payloads, args.rtol, args.atol, args.allow_extra)
+            all_ok &= report(name, diffs)
+    return 0 if all_ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())